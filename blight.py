@@ -1,127 +1,300 @@
 #!/usr/bin/python3
 
+import os
 import sys
-import gi
-gi.require_version("GUdev", "1.0")
-from gi.repository import GUdev, GLib, Gio
+import select
 
-import argparse
-from functools import partial
-import re
+from functools import lru_cache
+import time
 
-from math import floor, ceil, log, exp
-from bisect import bisect_right as bisect, bisect_left
-from operator import neg
+from math import floor, isfinite, isnan, log, exp
+from bisect import bisect_right as bisect
+
+SYSFS_CLASS = "/sys/class"
+
+# Seconds an enumeration of a subsystem stays valid
+ENUM_TTL = 5.0
+
+# inotify events for writes to a file
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+
+_gclient = None
+_enum_cache = {}
 
 def die(message):
 	print(message, file = sys.stderr)
 	exit(1)
 
-def get_default_device():
-	gclient = GUdev.Client()
-	devices = gclient.query_by_subsystem("backlight")
-	devices = [ (dev.get_sysfs_attr("type"), dev) for dev in devices ]
+def read_sysfs_attr(path, attr):
+	# The stripped value of a sysfs attribute, or None if it can't be read
+	try:
+		fd = os.open(os.path.join(path, attr), os.O_RDONLY)
+	except OSError:
+		return None
+	try:
+		return os.pread(fd, 4096, 0).decode().strip()
+	except OSError:
+		return None
+	finally:
+		os.close(fd)
+
+# A sysfs device, reading brightness through cached fds
+class _SysfsDev:
+	def __init__(self, subsystem, name, path = None):
+		self.subsystem = subsystem
+		self.name = name
+		self.path = path = path or os.path.join(SYSFS_CLASS, subsystem, name)
+
+		# Whether we may write brightness ourselves, found out on first write
+		self.writable = None
+
+		self.fd = None
+		try:
+			self.fd = os.open(os.path.join(path, "brightness"), os.O_RDONLY)
+
+			# max_brightness never changes for a device, read it only once
+			max_fd = os.open(os.path.join(path, "max_brightness"), os.O_RDONLY)
+			try:
+				self.max_brightness = int(os.pread(max_fd, 32, 0))
+			finally:
+				os.close(max_fd)
+		except OSError as e:
+			die(f"Cannot open device {subsystem}/{name}: {e.strerror}")
+
+	def __del__(self):
+		if self.fd is not None:
+			os.close(self.fd)
+
+	def read_attr(self, attr):
+		return read_sysfs_attr(self.path, attr)
+
+	def read_brightness(self):
+		return int(os.pread(self.fd, 32, 0))
+
+	def write_brightness(self, brightness):
+		# Write directly when allowed, e.g. by a udev rule for the video group.
+		# Returns False if the write has to go through logind instead.
+		if self.writable is None:
+			try:
+				fd = os.open(os.path.join(self.path, "brightness"), os.O_RDWR)
+			except PermissionError:
+				self.writable = False
+			else:
+				os.close(self.fd)
+				self.fd = fd
+				self.writable = True
+
+		if not self.writable:
+			return False
 
-	# Prefer firmware
-	for devtype, dev in devices:
+		try:
+			os.pwrite(self.fd, str(brightness).encode(), 0)
+		except PermissionError:
+			self.writable = False
+			return False
+		return True
+
+def _get_client():
+	global _gclient
+	if _gclient is None:
+		import gi
+		gi.require_version("GUdev", "1.0")
+		from gi.repository import GUdev
+		_gclient = GUdev.Client()
+	return _gclient
+
+def _query_subsystem(subsystem):
+	# (name, sysfs path) of the devices in a subsystem
+	cached = _enum_cache.get(subsystem)
+	if cached and time.monotonic() - cached[0] < ENUM_TTL:
+		return cached[1]
+
+	classdir = os.path.join(SYSFS_CLASS, subsystem)
+	try:
+		devices = [ (name, os.path.join(classdir, name)) for name in os.listdir(classdir) ]
+		# Same order as udev, which sorts by syspath
+		devices.sort(key = lambda device: os.path.realpath(device[1]))
+	except FileNotFoundError:
+		udevs = _get_client().query_by_subsystem(subsystem)
+		devices = [ (dev.get_name(), dev.get_sysfs_path()) for dev in udevs ]
+
+	_enum_cache[subsystem] = (time.monotonic(), devices)
+	return devices
+
+def find_default_device():
+	# (name, sysfs path) of the default backlight, without opening it
+	devices = _query_subsystem("backlight")
+
+	# Read each device type once
+	by_type = { "platform": [], "raw": [] }
+	for name, path in devices:
+		devtype = read_sysfs_attr(path, "type")
+
+		# Prefer firmware, no need to look any further
 		if devtype == "firmware":
-			return dev
+			return name, path
+
+		by_type.setdefault(devtype, []).append((name, path))
 
 	# ... then platform
-	for devtype, dev in devices:
-		if devtype == "platform":
-			return dev
+	if by_type["platform"]:
+		return by_type["platform"][0]
 
 	# ... then raw under enabled drm-connectors
-	for devtype, dev in devices:
-		if devtype == "raw":
-			parent = dev.get_parent()
-			enabled = parent.get_sysfs_attr("enabled")
-			if enabled == "enabled":
-				return dev
-	
+	for name, path in by_type["raw"]:
+		parent = os.path.realpath(os.path.join(path, "device"))
+		enabled = read_sysfs_attr(parent, "enabled")
+		if enabled == "enabled":
+			return name, path
+
 	die(f"Cannot find a suitable backlight device")
 
+def get_default_device():
+	name, path = find_default_device()
+	return _SysfsDev("backlight", name, path)
+
 def get_named_device(devname):
-	if '/' in devname:
-		try:
-			subsystem, name = devname.split('/')
-		except ValueError as e:
-			print(f"Invalid device name: {devname!r}")
-			exit(1)
-	else:
+	subsystem, sep, name = devname.partition('/')
+	if not sep:
 		subsystem = 'backlight'
 		name = devname
+	elif '/' in name:
+		die(f"Invalid device name: {devname!r}")
 
-	gclient = GUdev.Client()
-	dev = gclient.query_by_subsystem_and_name(subsystem, name)
+	dev = _get_client().query_by_subsystem_and_name(subsystem, name)
 	if dev:
-		return dev
+		return _SysfsDev(dev.get_subsystem(), dev.get_name(), dev.get_sysfs_path())
 	else:
 		die(f"No such device: {devname!r}")
 
+# replace a leading '-' before numbers so argparse keeps it as a value
+def escape(arg):
+	if len(arg) > 1 and arg[0] == '-' and arg[1] in '0123456789/':
+		return '\u2212' + arg[1:]
+	return arg
+
+def unescape(value):
+	if value.startswith('\u2212'):
+		return '-' + value[1:]
+	return value
+
+# argparse reports a ValueError as an invalid poll_interval value
+def poll_interval(value):
+	seconds = float(value)
+	if not (seconds > 0 and isfinite(seconds)):
+		raise ValueError(value)
+	return seconds
+
 def devname(dev):
-	subsystem = dev.get_subsystem()
-	name = dev.get_name()
-	return f"{subsystem}/{name}"
+	return f"{dev.subsystem}/{dev.name}"
+
+@lru_cache(maxsize = 32)
+def logscale(maxb, steps):
+	steps = min(maxb - 1, steps)
+
+	def log_scale(n):
+		# log of the ratio between levels stepping geometrically from n to maxb
+		return log(maxb / n) / (steps - n + 1)
+
+	# Find the first level n from which geometric steps are more than one
+	# unit apart. That separation grows with n, so bisect for it.
+	lo, hi = 1, max(1, steps - 1)
+	while lo < hi:
+		mid = (lo + hi) // 2
+		if mid * (exp(log_scale(mid)) - 1) > 1:
+			hi = mid
+		else:
+			lo = mid + 1
+	n = min(lo, steps)
 
-def logsteps(maxb, steps):
-    steps = min(maxb - 1, steps)
-    ret = list(range(1, steps + 1)) + [maxb]
-    for n in range(1, steps):
-        scale = (maxb / n) ** (1 / (steps - n + 1))
-        sep = n * (scale - 1)
-        if sep > 1: break
-    for maxb in range(n, steps):
-        ret[maxb] = ret[maxb - 1] * scale
-    return list(map(round, ret))
+	return steps, n, log_scale(n) if n < steps else 0
 
+@lru_cache(maxsize = 32)
+def logsteps(maxb, steps):
+	steps, n, scale = logscale(maxb, steps)
+
+	# Linear steps up to n, then geometric steps up to maxb
+	linear = tuple(range(1, n + 1))
+	geometric = tuple(round(n * exp(k * scale)) for k in range(1, steps - n + 1))
+	return linear + geometric + (maxb,)
+
+def loglevel(maxb, steps, brightness):
+	# Index of the first level in logsteps(maxb, steps) above brightness
+	levels = logsteps(maxb, steps)
+	steps, n, scale = logscale(maxb, steps)
+	if brightness < n or not scale:
+		return bisect(levels, brightness)
+
+	# Levels from n on are about n * exp(k * scale), so solve for k.
+	# Rounding the levels may leave the estimate one off.
+	level = min(len(levels), n + int((log(brightness) - log(n)) / scale))
+	while level < len(levels) and levels[level] <= brightness:
+		level += 1
+	while levels[level - 1] > brightness:
+		level -= 1
+	return level
 
 def make_brightness_param(brightness, dev):
+	from gi.repository import GLib
 	return GLib.Variant(
 		'(ssu)',
-		[
-			dev.get_subsystem(),
-			dev.get_name(),
-			round(brightness),
-		]
+		(
+			dev.subsystem,
+			dev.name,
+			brightness,
+		)
 	)
 
-def parse_set_value(target, dev):
-	max_brightness = dev.get_sysfs_attr_as_int("max_brightness")
-	cur_brightness = dev.get_sysfs_attr_as_int("brightness")
+def parse_set_value(target, dev, cur_brightness):
+	max_brightness = dev.max_brightness
 	percent = max_brightness / 100
 
-	if max_brightness < 99 and dev.get_sysfs_attr("type") == "raw":
+	if max_brightness < 99 and dev.read_attr("type") == "raw":
 		min_brightness = 0
-	elif dev.get_subsystem() != "backlight":
+	elif dev.subsystem != "backlight":
 		min_brightness = 0
 	else:
 		min_brightness = 1
 
 	def clamp(brightness):
+		if isnan(brightness):
+			die(f"Invalid brightness value: {target!r}")
+
+		# Round half up, after clamping so infinite values work
 		if brightness < min_brightness:
 			return min_brightness
 		if brightness > max_brightness:
 			return max_brightness
-		return brightness
+		return floor(brightness + 0.5)
+
+	head = target[:1]
+	signed = head == '+' or head == '-'
 
 	# Log step
-	if target.startswith('+//') or target.startswith('-//'):
-		steps = int(target[0] + target[3:])
+	if signed and target[1:3] == '//':
+		try:
+			steps = int(target[0] + target[3:])
+		except ValueError as e:
+			die(f"Invalid brightness value: {target!r}")
+
+		if not steps:
+			die(f"Invalid brightness value: {target!r}")
+
+		levels = logsteps(max_brightness, abs(steps))
+		level = loglevel(max_brightness, abs(steps), cur_brightness)
 		if steps < 0:
-			levels = logsteps(max_brightness, -steps)
-			level = bisect_left(levels, cur_brightness)
+			# Step below a level we are exactly on
+			if level and levels[level - 1] == cur_brightness:
+				level -= 1
 			brightness = levels[max(0, level - 1)]
 		else:
-			levels = logsteps(max_brightness, steps)
-			level = bisect(levels, cur_brightness)
-			brightness = levels[min(steps, level)]
+			brightness = levels[min(len(levels) - 1, level)]
 
 		return clamp(brightness)
 
 	# Linear step
-	if target.startswith('+/') or target.startswith('-/'):
+	if signed and target[1:2] == '/':
 		try:
 			steps = max_brightness // int(target[0] + target[2:])
 		except ValueError as e:
@@ -135,13 +308,13 @@ def parse_set_value(target, dev):
 		return clamp(brightness)
 
 	# Relative set
-	if target.startswith('x'):
+	if head == 'x':
 		try:
 			scale = float(target[1:])
 		except ValueError as e:
 			die(f"Invalid brightness value: {target!r}")
 
-		brightness = round(cur_brightness * scale)
+		brightness = clamp(cur_brightness * scale)
 		if brightness == cur_brightness:
 			if scale > 1:
 				brightness += 1
@@ -150,13 +323,16 @@ def parse_set_value(target, dev):
 
 		return clamp(brightness)
 
-	if target.startswith('/'):
+	if head == '/':
 		try:
 			scale = float(target[1:])
 		except ValueError as e:
 			die(f"Invalid brightness value: {target!r}")
 
-		brightness = round(cur_brightness / scale)
+		if not scale:
+			die(f"Invalid brightness value: {target!r}")
+
+		brightness = clamp(cur_brightness / scale)
 		if brightness == cur_brightness:
 			if scale > 1:
 				brightness -= 1
@@ -165,34 +341,44 @@ def parse_set_value(target, dev):
 
 		return clamp(brightness)
 
-	brightness = 0
-	if target.startswith('+') or target.startswith('-'):
-		brightness = cur_brightness
+	brightness = cur_brightness if signed else 0
 
 	# Absolute set
-	value = 0
 	try:
-		if target.endswith('%'):
-			value += float(target[:-1]) * percent
-		else:
-			value += float(target)
+		value = float(target[:-1]) * percent if target.endswith('%') else float(target)
 	except ValueError as e:
 		die(f"Invalid brightness value: {target!r}")
-	
-	if value == 0:
+
+	# An absolute 0 turns the device off, a relative 0 changes nothing
+	if not value:
 		return brightness
-	else:
-		return clamp(brightness + value)
+	return clamp(brightness + value)
 
 def set_brightness(target, dev = None):
 	if not dev:
 		dev = get_default_device()
 
-	brightness = parse_set_value(target, dev)
+	cur_brightness = dev.read_brightness()
+	brightness = parse_set_value(target, dev, cur_brightness)
+	if brightness == cur_brightness:
+		return
+
+	write_brightness(brightness, dev)
+
+def write_brightness(brightness, dev):
+	# Skip the logind round-trip if we can write the device ourselves
+	try:
+		if dev.write_brightness(brightness):
+			return
+	except OSError as e:
+		die(f"Cannot set brightness: {e.strerror}")
+
 	param = make_brightness_param(brightness, dev)
 	logind_set_brightness(param)
 
 def logind_set_brightness(param):
+	from gi.repository import GLib, Gio
+
 	method = [
 		'org.freedesktop.login1',
 		'/org/freedesktop/login1/session/auto',
@@ -209,9 +395,8 @@ def logind_set_brightness(param):
 	except GLib.GError as e:
 		print(e.message, file = sys.stderr)
 
-def parse_toggle_value(target, dev):
-	max_brightness = dev.get_sysfs_attr_as_int("max_brightness")
-	cur_brightness = dev.get_sysfs_attr_as_int("brightness")
+def parse_toggle_value(target, dev, cur_brightness):
+	max_brightness = dev.max_brightness
 
 	if not target:
 		brightness = (cur_brightness + 1) % (max_brightness + 1)
@@ -233,20 +418,65 @@ def toggle_leds(target, dev = None):
 	if not dev:
 		dev = get_default_device()
 
-	brightness = parse_toggle_value(target, dev)
-	param = make_brightness_param(brightness, dev)
-	logind_set_brightness(param)
+	cur_brightness = dev.read_brightness()
+	brightness = parse_toggle_value(target, dev, cur_brightness)
+	if brightness == cur_brightness:
+		return
+
+	write_brightness(brightness, dev)
+
+def inotify_watch(paths):
+	# An inotify fd watching the existing paths, or None if unavailable
+	import ctypes
+	try:
+		libc = ctypes.CDLL(None, use_errno = True)
+		fd = libc.inotify_init1(os.O_CLOEXEC)
+	except (OSError, AttributeError):
+		return None
+	if fd < 0:
+		return None
+	watches = [ libc.inotify_add_watch(fd, os.fsencode(path), IN_MODIFY | IN_CLOSE_WRITE) for path in paths ]
+	if max(watches, default = -1) < 0:
+		os.close(fd)
+		return None
+	return fd
+
+def watch_brightness(dev = None, interval = None):
+	if not dev:
+		dev = get_default_device()
+
+	# Writes to brightness are seen on the file itself, while the kernel
+	# only notifies actual_brightness about hotkey and firmware changes.
+	# Some drivers do neither, poll as well if asked to or if inotify is
+	# unavailable.
+	interval = interval or None
+	paths = [ os.path.join(dev.path, attr) for attr in ("brightness", "actual_brightness") ]
+	ifd = inotify_watch(paths)
+	if ifd is None and interval is None:
+		interval = 1.0
+	watched = [] if ifd is None else [ifd]
+
+	last = None
+	while True:
+		brightness = dev.read_brightness()
+		if brightness != last:
+			print(brightness, flush = True)
+			last = brightness
+
+		ready, _, _ = select.select(watched, [], [], interval)
+		if ready:
+			os.read(ifd, 4096)
 
 getters = {
 	'default-device': None, # Handled
-	'brightness': lambda dev: dev.get_sysfs_attr("brightness"),
-	'max-brightness': lambda dev: dev.get_sysfs_attr("max_brightness"),
+	'brightness': lambda dev: dev.read_brightness(),
+	'max-brightness': lambda dev: dev.max_brightness,
 }
 
 def get_value(value, dev = None):
 	if value == "default-device":
-		dev = get_default_device()
-		return devname(dev)
+		name, path = find_default_device()
+		return f"backlight/{name}"
 
 	if value == "help":
 		return list(getters)
@@ -262,32 +492,40 @@ def get_value(value, dev = None):
 		die(f"Unknown query: {value!r}")
 
 if __name__ == "__main__":
+	# Status bars poll these often, answer them without building the parser
+	fast_gets = (['get'], ['get', 'brightness'], ['get', 'max-brightness'], ['get', 'default-device'])
+	if sys.argv[1:] in fast_gets:
+		print(get_value(sys.argv[2] if len(sys.argv) > 2 else None))
+		sys.exit(0)
+
+	import argparse
+
 	parser = argparse.ArgumentParser(prog = "blight")
 	parser.add_argument('-d', '--device', help = "Which backlight device to modify")
 
 	subparsers = parser.add_subparsers(dest = "action", required = True)
 
 	parser_set = subparsers.add_parser("set", help = "Set an exact or relative brightness value")
-	parser_set.add_argument("value", help = "A brightness value.")
+	parser_set.add_argument("value", type = unescape, help = "A brightness value.")
 
 	parser_get = subparsers.add_parser("get", help = "Inspect brightness devices")
 	parser_get.add_argument("value", help = "Value to get", nargs = '?')
 
 	parser_toggle = subparsers.add_parser("toggle", help = "Toggle a led")
-	parser_toggle.add_argument("value", help = "Value to toggle when on", nargs = '?')
+	parser_toggle.add_argument("value", type = unescape, help = "Value to toggle when on", nargs = '?')
+
+	parser_watch = subparsers.add_parser("watch", help = "Print the brightness whenever it changes")
+	parser_watch.add_argument("--poll-interval", type = poll_interval, help = "Also poll every this many seconds")
 
 	# replace '-' for numbers
-	escape = partial(re.sub, r'^-(?=[0-9/])', '\u2212')
 	argv = list(map(escape, sys.argv[1:]))
 	args = parser.parse_args(argv)
 	dev = get_named_device(args.device) if args.device else None
 
 	if args.action == "set":
-		value = args.value.replace('\u2212', '-')
-		set_brightness(value, dev = dev)
+		set_brightness(args.value, dev = dev)
 	elif args.action == "toggle":
-		value = args.value and args.value.replace('\u2212', '-')
-		toggle_leds(value, dev = dev)
+		toggle_leds(args.value, dev = dev)
 	elif args.action == "get":
 		result = get_value(args.value, dev = dev)
 		if isinstance(result, list):
@@ -295,3 +533,11 @@ if __name__ == "__main__":
 				print(item)
 		else:
 			print(result)
+	elif args.action == "watch":
+		try:
+			watch_brightness(dev = dev, interval = args.poll_interval)
+		except KeyboardInterrupt:
+			pass
+		except BrokenPipeError:
+			# The reader went away; keep the exit-time flush from failing again
+			os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())